@@ -223,13 +223,24 @@ def main():
         '--finali', type=int, default=3,
         help='Il numero di capitoli finali.\nDefault: 3'
     )
+    parser.add_argument(
+        '--seme', type=int, default=None,
+        help='Seme del generatore casuale, per ottenere sempre lo stesso file.\nDefault: casuale'
+    )
+    parser.add_argument(
+        '--nomefile', type=str, default='librogame',
+        help='Nome del file .twee da creare (senza estensione).\nDefault: librogame'
+    )
     parser.add_argument(
         '-v', '--verbose', action='store_true',
         help='Attiva la modalità verbosa per visualizzare i dettagli.'
     )
     args = parser.parse_args()
     
-    NOME_FILE_OUTPUT = "librogame.twee"
+    if args.seme is not None:
+        random.seed(args.seme)
+    
+    NOME_FILE_OUTPUT = f"{args.nomefile}.twee"
     
     genera_librogame(
         args.capitoli,
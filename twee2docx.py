@@ -1,14 +1,20 @@
 # -*- coding: utf-8 -*-
 
 import re
-import docx
 import argparse
 import glob
+import io
+import json
+import mmap
+import multiprocessing
 import os
 import random
 import time
 import sys
-from docx.shared import Pt
+import zipfile
+from abc import ABC, abstractmethod
+from itertools import islice
+from xml.sax.saxutils import escape
 
 # Prova a importare networkx e avvisa l'utente se manca
 try:
@@ -66,6 +72,85 @@ def parse_twee_file(file_path):
     print(f"Analisi completata. Trovati {len(passages)} passaggi validi.")
     return passages
 
+def index_twee_file(file_path):
+    """
+    Variante a memoria ridotta di parse_twee_file: il file viene mappato in memoria
+    e per ogni passaggio si conservano solo posizione nel file e rimandi.
+    Restituisce i passaggi e il file mappato, da cui il testo viene riletto in esportazione.
+    """
+    print(f"Inizio indicizzazione del file: {file_path}")
+    passages = []
+    current_passage = None
+
+    try:
+        with open(file_path, 'rb') as f:
+            source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        print(f"Errore: File non trovato a questo percorso: {file_path}")
+        return [], None
+    except ValueError:
+        print(f"Errore: Il file '{file_path}' è vuoto.")
+        return [], None
+
+    def close_passage(end):
+        current_passage['end'] = end
+        content = read_passage_content(source, current_passage)
+        current_passage['link_targets'] = _link_targets(content)
+        current_passage['link_texts'] = _link_texts(content)
+        passages.append(current_passage)
+
+    line_start = 0
+    while True:
+        line = source.readline()
+        if not line:
+            break
+        match = re.match(r'^::\s*([^[{]+)', line.decode('utf-8')) if line.startswith(b'::') else None
+        if match:
+            if current_passage:
+                close_passage(line_start)
+                current_passage = None
+            original_id = match.group(1).strip()
+            if original_id not in ["StoryTitle", "StoryData"]:
+                current_passage = {
+                    'original_id': original_id,
+                    'title': original_id,
+                    'start': source.tell()
+                }
+        line_start = source.tell()
+
+    if current_passage:
+        close_passage(line_start)
+
+    print(f"Indicizzazione completata. Trovati {len(passages)} passaggi validi.")
+    return passages, source
+
+def read_passage_content(source, passage):
+    """Rilegge dal file mappato il testo di un passaggio indicizzato, normalizzato come in parse_twee_file."""
+    content = source[passage['start']:passage['end']].decode('utf-8')
+    return content.replace('\r\n', '\n').replace('\r', '\n').strip()
+
+def parse_story_data(file_path):
+    """
+    Legge il blocco StoryData (JSON) del file Twee e lo restituisce come dizionario.
+    Restituisce un dizionario vuoto se il blocco manca o non è valido.
+    """
+    lines = []
+    inside_block = False
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                match = re.match(r'^::\s*([^[{]+)', line)
+                if match:
+                    if inside_block:
+                        break
+                    inside_block = match.group(1).strip() == "StoryData"
+                elif inside_block:
+                    lines.append(line)
+        story_data = json.loads(''.join(lines)) if lines else {}
+        return story_data if isinstance(story_data, dict) else {}
+    except (FileNotFoundError, ValueError):
+        return {}
+
 def _print_stats_report(title, id_map, links):
     """Stampa una tabella formattata con le statistiche del layout."""
     avg, max_d, min_d = _calculate_layout_stats(id_map, links)
@@ -315,6 +400,93 @@ def _is_swap_valid(id_map, links, node1, node2, min_dist):
     
     return True
 
+def _link_targets(content):
+    """Restituisce gli ID di destinazione dei rimandi di un capitolo."""
+    # Il primo numero tra le doppie quadre è l'ID del capitolo di destinazione
+    return re.findall(r'\[\[(?:[^\]]*?)(\d+)(?:[^\]]*?)\]\]', content)
+
+def _link_texts(content):
+    """Restituisce il testo completo dei rimandi di un capitolo, senza le doppie quadre."""
+    return re.findall(r'\[\[([^\]]+)\]\]', content)
+
+def _original_links_text(content):
+    """Restituisce i rimandi originali di un capitolo per la riga di debug."""
+    original_links_text = _link_texts(content)
+    return ", ".join(original_links_text) if original_links_text else "Nessuno"
+
+def _extract_links(passages):
+    """
+    Estrae i rimandi numerici dai passaggi.
+    Restituisce i link validi e quelli verso capitoli inesistenti (dangling).
+    """
+    all_passage_ids = {p['original_id'] for p in passages}
+    links, dangling_links = [], []
+
+    for p in passages:
+        dest_ids = p['link_targets'] if 'link_targets' in p else _link_targets(p['content'])
+        for dest_id in dest_ids:
+            link = {'source': p['original_id'], 'dest': dest_id}
+            if dest_id in all_passage_ids:
+                links.append(link)
+            else:
+                dangling_links.append(link)
+
+    return links, dangling_links
+
+def _resolve_link_target(link_text, all_passage_ids):
+    """
+    Individua il capitolo di destinazione di un rimando come fa Twine: prima il nome esatto
+    del capitolo ([[dest]], [[testo|dest]], [[testo->dest]], [[dest<-testo]]), poi il primo numero.
+    """
+    if '|' in link_text:
+        target = link_text.rsplit('|', 1)[1]
+    elif '->' in link_text:
+        target = link_text.rsplit('->', 1)[1]
+    elif '<-' in link_text:
+        target = link_text.split('<-', 1)[0]
+    else:
+        target = link_text
+    target = target.strip()
+    if target in all_passage_ids:
+        return target
+    number_match = re.search(r'(\d+)', link_text)
+    return number_match.group(1) if number_match else target
+
+def _extract_story_links(passages):
+    """
+    Estrae tutti i rimandi, per nome o per numero, per l'analisi strutturale.
+    Restituisce i link validi e quelli verso capitoli inesistenti (dangling).
+    """
+    all_passage_ids = {p['original_id'] for p in passages}
+    links, dangling_links = [], []
+
+    for p in passages:
+        link_texts = p['link_texts'] if 'link_texts' in p else _link_texts(p['content'])
+        for link_text in link_texts:
+            link = {'source': p['original_id'], 'dest': _resolve_link_target(link_text, all_passage_ids)}
+            if link['dest'] in all_passage_ids:
+                links.append(link)
+            else:
+                dangling_links.append(link)
+
+    return links, dangling_links
+
+def _relink_content(content, id_map):
+    """
+    Aggiorna i rimandi di un capitolo con i nuovi ID.
+    Ogni rimando viene riscritto una sola volta, così un ID appena assegnato
+    non può essere scambiato per il vecchio ID di un altro rimando.
+    """
+    def replace_link(match):
+        link_text = match.group(1)
+        old_link_id_match = re.search(r'(\d+)', link_text)
+        if old_link_id_match and old_link_id_match.group(1) in id_map:
+            old_id = old_link_id_match.group(1)
+            link_text = re.sub(r'\b' + re.escape(old_id) + r'\b', str(id_map[old_id]), link_text)
+        return f'[[{link_text}]]'
+
+    return re.sub(r'\[\[([^\]]+)\]\]', replace_link, content)
+
 def renumber_passages_hybrid(passages, min_dist, locked_ids, start_number, correction_passes):
     """
     Motore di rinumerazione ibrido definitivo: Bozza strategica + Correzione robusta.
@@ -326,21 +498,14 @@ def renumber_passages_hybrid(passages, min_dist, locked_ids, start_number, corre
     
     # FASE 1: Analisi Strutturale
     print("Fase 1: Analisi della struttura...")
-    links = []
-    all_passage_ids = {p['original_id'] for p in passages}
+    links, dangling_links = _extract_links(passages)
     G = nx.Graph()
-    G.add_nodes_from(all_passage_ids)
-    
-    # Miglioramento del pattern regex per catturare meglio i link
-    link_pattern = r'\[\[(?:[^\]]*?)(\d+)(?:[^\]]*?)\]\]'
-    
-    for p in passages:
-        for dest_id in re.findall(link_pattern, p['content']):
-            if dest_id in all_passage_ids:
-                links.append({'source': p['original_id'], 'dest': dest_id})
-                G.add_edge(p['original_id'], dest_id)
+    G.add_nodes_from(p['original_id'] for p in passages)
+    G.add_edges_from((link['source'], link['dest']) for link in links)
     
     print(f"  Trovati {len(links)} link tra i passaggi")
+    if dangling_links:
+        print(f"  Avviso: {len(dangling_links)} rimandi puntano a capitoli inesistenti e saranno ignorati")
     
     # FASE 2: Setup ID mapping corretto
     initial_id_map, available_new_ids = _setup_initial_id_mapping(passages, locked_ids, start_number)
@@ -393,83 +558,531 @@ def renumber_passages_hybrid(passages, min_dist, locked_ids, start_number, corre
         if new_id is None: 
             continue
         
-        original_links_text = re.findall(r'\[\[([^\]]+)\]\]', p['content'])
-        p['original_links_text'] = ", ".join(original_links_text) if original_links_text else "Nessuno"
-
-        new_content = p['content']
-        for link_text in original_links_text:
-            old_link_id_match = re.search(r'(\d+)', link_text)
-            if old_link_id_match and old_link_id_match.group(1) in final_id_map:
-                old_id = old_link_id_match.group(1)
-                new_id_val = final_id_map[old_id]
-                updated_link_text = re.sub(r'\b' + re.escape(old_id) + r'\b', str(new_id_val), link_text)
-                new_content = new_content.replace(f'[[{link_text}]]', f'[[{updated_link_text}]]')
-        
         p['new_id'] = new_id
-        p['content'] = new_content
+        # Con l'indice su disco il testo non è in memoria: i rimandi vengono aggiornati in esportazione
+        if 'content' in p:
+            p['original_links_text'] = _original_links_text(p['content'])
+            p['content'] = _relink_content(p['content'], final_id_map)
         updated_passages.append(p)
         
     print("Rinumerazione completata.")
     return updated_passages, stats_summary
 
-def export_to_docx(passages, output_filename, debug_mode, script_start_time, stats):
+# --- Analisi strutturale ---
+
+def _strongly_connected_components(adjacency):
+    """
+    Algoritmo di Tarjan iterativo (tempo lineare) su una lista di adiacenza compatta.
+    Restituisce le componenti come liste di indici.
+    """
+    index_of = [None] * len(adjacency)
+    lowlink = [0] * len(adjacency)
+    on_stack = [False] * len(adjacency)
+    stack, components = [], []
+    counter = 0
+
+    for root in range(len(adjacency)):
+        if index_of[root] is not None:
+            continue
+        work = [(root, 0)]
+        while work:
+            node, edge_pos = work.pop()
+            if edge_pos == 0:
+                index_of[node] = lowlink[node] = counter
+                counter += 1
+                stack.append(node)
+                on_stack[node] = True
+            recurse = False
+            neighbors = adjacency[node]
+            while edge_pos < len(neighbors):
+                succ = neighbors[edge_pos]
+                edge_pos += 1
+                if index_of[succ] is None:
+                    work.append((node, edge_pos))
+                    work.append((succ, 0))
+                    recurse = True
+                    break
+                if on_stack[succ]:
+                    lowlink[node] = min(lowlink[node], index_of[succ])
+            if recurse:
+                continue
+            if lowlink[node] == index_of[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(component)
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+    return components
+
+def analyze_structure(passages, links, dangling_links, start_id):
+    """
+    Costruisce gli indici di raggiungibilità dal capitolo iniziale e individua
+    capitoli non raggiungibili, vicoli ciechi, rimandi interrotti e cicli.
+    """
+    ids = [p['original_id'] for p in passages]
+    position = {passage_id: i for i, passage_id in enumerate(ids)}
+
+    # Adiacenza compatta: indici interi, rimandi duplicati rimossi (il dizionario mantiene l'ordine)
+    successors = [{} for _ in ids]
+    for link in links:
+        successors[position[link['source']]][position[link['dest']]] = None
+    adjacency = [list(succ) for succ in successors]
+
+    # Visita in ampiezza dal capitolo iniziale
+    depth = [None] * len(ids)
+    if start_id in position:
+        depth[position[start_id]] = 0
+        queue = [position[start_id]]
+        for node in queue:
+            for succ in adjacency[node]:
+                if depth[succ] is None:
+                    depth[succ] = depth[node] + 1
+                    queue.append(succ)
+    else:
+        print(f"  Avviso: il capitolo iniziale '{start_id}' non esiste")
+
+    cycles = [
+        [ids[i] for i in sorted(component)]
+        for component in _strongly_connected_components(adjacency)
+        if len(component) > 1 or component[0] in successors[component[0]]
+    ]
+    cycles.sort(key=lambda component: position[component[0]])
+    reachable_depths = [d for d in depth if d is not None]
+
+    return {
+        'passages': len(ids),
+        'links': len(links),
+        'start': start_id,
+        'reachable': len(reachable_depths),
+        'max_depth': max(reachable_depths, default=0),
+        'unreachable': [ids[i] for i in range(len(ids)) if depth[i] is None],
+        'dead_ends': [ids[i] for i in range(len(ids)) if not adjacency[i]],
+        'dangling_links': dangling_links,
+        'cycles': cycles,
+    }
+
+def _link_distance_distribution(id_map, links, min_dist):
+    """Calcola la distribuzione delle distanze tra capitoli collegati secondo la numerazione indicata."""
+    links = [link for link in links if link['source'] in id_map and link['dest'] in id_map]
+    histogram = {}
+    for link in links:
+        distance = abs(id_map[link['dest']] - id_map[link['source']])
+        histogram[distance] = histogram.get(distance, 0) + 1
+
+    avg_dist, max_dist, min_found = _calculate_layout_stats(id_map, links)
+    return {
+        'average': avg_dist,
+        'max': max_dist,
+        'min': min_found,
+        'below_min_dist': sum(count for distance, count in histogram.items() if distance < min_dist),
+        'histogram': {str(distance): histogram[distance] for distance in sorted(histogram)},
+    }
+
+def _print_analysis_report(report):
+    """Stampa un riepilogo dell'analisi strutturale."""
+    print("\n--- Analisi Strutturale ---")
+    print(f"{'Controllo':<28} | {'Valore':>10}")
+    print("-" * 41)
+    print(f"{'Capitoli':<28} | {report['passages']:>10}")
+    print(f"{'Rimandi validi':<28} | {report['links']:>10}")
+    print(f"{'Raggiungibili':<28} | {report['reachable']:>10}")
+    print(f"{'Non raggiungibili':<28} | {len(report['unreachable']):>10}")
+    print(f"{'Vicoli ciechi':<28} | {len(report['dead_ends']):>10}")
+    print(f"{'Rimandi interrotti':<28} | {len(report['dangling_links']):>10}")
+    print(f"{'Cicli':<28} | {len(report['cycles']):>10}")
+    print(f"{'Sotto la distanza minima':<28} | {report['distances']['below_min_dist']:>10}")
+    if 'distances_renumbered' in report:
+        print(f"{'  dopo la rinumerazione':<28} | {report['distances_renumbered']['below_min_dist']:>10}")
+    print("-" * 41)
+
+def export_analysis(passages, output_filename, start_id, script_start_time, renumber=False, **renumber_args):
+    """
+    Analizza la struttura del libro e le distanze dei rimandi numerici secondo la numerazione
+    attuale e salva il risultato in JSON. Con renumber=True misura le distanze anche dopo
+    la rinumerazione, che sui libri grandi richiede molto più tempo dell'analisi.
+    """
+    print("\n--- Analisi della struttura ---")
+    story_links, dangling_links = _extract_story_links(passages)
+    report = analyze_structure(passages, story_links, dangling_links, start_id)
+
+    # Le distanze hanno senso solo per i rimandi numerici, gli unici che vengono rinumerati
+    links, _ = _extract_links(passages)
+    current_id_map = {p['original_id']: int(p['original_id']) for p in passages if p['original_id'].isdigit()}
+    report['distances'] = _link_distance_distribution(current_id_map, links, renumber_args['min_dist'])
+
+    stats = None
+    if renumber:
+        final_passages, stats = renumber_passages_hybrid(passages=passages, **renumber_args)
+        id_map = {p['original_id']: p['new_id'] for p in final_passages}
+        report['distances_renumbered'] = _link_distance_distribution(id_map, links, renumber_args['min_dist'])
+
+    try:
+        with open(output_filename, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Successo! File '{output_filename}' creato correttamente.")
+        _print_analysis_report(report)
+        if stats:
+            _print_final_report(stats, script_start_time)
+        else:
+            print(f"\nTempo di esecuzione totale: {time.time() - script_start_time:.2f} secondi.")
+    except Exception as e:
+        print(f"Errore durante il salvataggio del file JSON: {e}")
+
+def _split_link_runs(content):
+    """
+    Divide il contenuto di un capitolo in segmenti (testo, grassetto).
+    Nei rimandi il numero è in grassetto e le parentesi vengono rimosse.
+    """
+    runs = []
+    for part in re.split(r'(\[\[.*?\]\])', content):
+        if part.startswith('[['):
+            link_text = part.strip('[]')
+            number_match = re.search(r'(\d+)', link_text)
+            if number_match:
+                number = number_match.group(1)
+                before_number, after_number = link_text.split(number, 1)
+                runs.append((before_number, False))
+                runs.append((number, True))
+                runs.append((after_number, False))
+            else:
+                runs.append((link_text, False))
+        else:
+            runs.append((part, False))
+    return runs
+
+# Caratteri non ammessi in XML 1.0 (es. \x0b, frequente nei testi incollati)
+_INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+
+def _xml_text(text):
+    """Prepara il testo per un documento XML: rimuove i caratteri non ammessi ed esegue l'escape."""
+    return escape(_INVALID_XML_CHARS.sub('', text))
+
+def _debug_text(passage):
+    """Restituisce la riga di debug con ID e rimandi originali del capitolo."""
+    return f"(Debug: ID Originale: {passage['original_id']}, Rimandi Originali: [{passage.get('original_links_text', 'Nessuno')}])"
+
+def _iter_chapters(passages, source=None):
+    """
+    Restituisce i capitoli in ordine di new_id.
+    Con l'indice su disco il testo di ogni capitolo viene riletto e aggiornato solo quando serve.
+    """
+    sorted_passages = sorted(passages, key=lambda p: p['new_id'])
+    if source is None:
+        yield from sorted_passages
+        return
+
+    id_map = {p['original_id']: p['new_id'] for p in passages}
+    for p in sorted_passages:
+        content = read_passage_content(source, p)
+        yield dict(p, content=_relink_content(content, id_map), original_links_text=_original_links_text(content))
+
+def _print_final_report(stats, script_start_time):
+    """Stampa il confronto finale tra layout iniziale e risultato, con il tempo totale."""
+    before_avg, before_max, before_min = stats['before']
+    after_avg, after_max, after_min = stats['after']
+
+    print("\n--- Report Statistiche Ottimizzazione (Finale) ---")
+    print(f"{'Statistica':<20} | {'Layout Iniziale':>15} | {'Risultato Finale':>18}")
+    print("-" * 60)
+    print(f"{'Distanza Media':<20} | {before_avg:>15.2f} | {after_avg:>18.2f}")
+    print(f"{'Distanza Massima':<20} | {before_max:>15} | {after_max:>18}")
+    print(f"{'Distanza Minima':<20} | {before_min:>15} | {after_min:>18}")
+    print("-" * 60)
+
+    script_end_time = time.time()
+    execution_time = script_end_time - script_start_time
+    print(f"\nTempo di esecuzione totale: {execution_time:.2f} secondi.")
+    sys.stdout.flush()
+
+# Sotto questa soglia il costo di avvio dei processi supera il guadagno
+_PARALLEL_MIN_CHAPTERS = 500
+# Capitoli inviati al pool per volta, per non caricare in memoria l'intero libro
+_PARALLEL_BATCH_SIZE = 2000
+
+def _docx_run_xml(text, run_properties=''):
+    """
+    Restituisce l'XML di un run WordprocessingML, identico a quello prodotto da python-docx
+    (tab e a capo diventano <w:tab/> e <w:br/>). I caratteri non ammessi in XML vengono rimossi.
+    """
+    inner = []
+    for piece in re.split(r'([\t\r\n])', _INVALID_XML_CHARS.sub('', text)):
+        if piece == '\t':
+            inner.append('<w:tab/>')
+        elif piece in ('\r', '\n'):
+            inner.append('<w:br/>')
+        elif piece:
+            space = ' xml:space="preserve"' if len(piece.strip()) < len(piece) else ''
+            inner.append(f'<w:t{space}>{escape(piece)}</w:t>')
+    if not inner:
+        return '<w:r/>'
+    return f"<w:r>{run_properties}{''.join(inner)}</w:r>"
+
+def _render_docx_chapter(chapter):
+    """
+    Genera il frammento XML di un capitolo (titolo, testo ed eventuale riga di debug).
+    Riceve una tupla (new_id, content, debug_text) per poter essere eseguita nei processi worker.
+    """
+    new_id, content, debug_text = chapter
+    fragment = [
+        '<w:p><w:pPr><w:pStyle w:val="Heading1"/><w:keepNext/><w:keepLines/></w:pPr>',
+        _docx_run_xml(f"Capitolo {new_id}"),
+        '</w:p><w:p><w:pPr><w:keepLines/></w:pPr>',
+    ]
+    for text, bold in _split_link_runs(content):
+        fragment.append(_docx_run_xml(text, '<w:rPr><w:b/></w:rPr>' if bold else ''))
+    fragment.append('</w:p>')
+    if debug_text is not None:
+        fragment.append('<w:p>')
+        fragment.append(_docx_run_xml(debug_text, '<w:rPr><w:i/><w:sz w:val="16"/></w:rPr>'))
+        fragment.append('</w:p>')
+    return ''.join(fragment)
+
+def _render_docx_fragments(chapters, chapter_count, processes):
+    """
+    Genera i frammenti dei capitoli, in parallelo se richiesto.
+    L'ordine di uscita è sempre quello di ingresso, quindi il documento non cambia col numero di processi.
+    """
+    if processes > 1 and chapter_count >= _PARALLEL_MIN_CHAPTERS:
+        print(f"  Generazione capitoli con {processes} processi...")
+        chunksize = max(1, _PARALLEL_BATCH_SIZE // (processes * 4))
+        with multiprocessing.Pool(processes) as pool:
+            while True:
+                batch = list(islice(chapters, _PARALLEL_BATCH_SIZE))
+                if not batch:
+                    break
+                yield from pool.imap(_render_docx_chapter, batch, chunksize)
+    else:
+        for chapter in chapters:
+            yield _render_docx_chapter(chapter)
+
+def _write_docx_package(fragments, output_filename):
+    """
+    Scrive il file .docx partendo dal modello vuoto di python-docx e inserendo
+    i frammenti nel corpo di word/document.xml man mano che arrivano.
+    Il file viene scritto con un nome temporaneo e rinominato solo a fine scrittura,
+    così un errore non lascia un documento incompleto.
+    """
+    # Import ritardato: python-docx serve solo per questo formato
+    import docx
+
+    template = io.BytesIO()
+    docx.Document().save(template)
+
+    temp_filename = output_filename + '.tmp'
+    try:
+        with zipfile.ZipFile(template) as src, zipfile.ZipFile(temp_filename, 'w', zipfile.ZIP_DEFLATED) as dst:
+            for item in src.infolist():
+                if item.filename != 'word/document.xml':
+                    dst.writestr(item, src.read(item))
+                    continue
+
+                document_xml = src.read(item).decode('utf-8')
+                body_start = document_xml.index('<w:body>') + len('<w:body>')
+                body_end = document_xml.find('<w:sectPr', body_start)
+                if body_end == -1:
+                    body_end = document_xml.index('</w:body>', body_start)
+
+                # La dimensione finale non è nota in anticipo: zip64 serve per i libri oltre 2 GiB
+                with dst.open(item, 'w', force_zip64=True) as out:
+                    out.write(document_xml[:body_end].encode('utf-8'))
+                    for fragment in fragments:
+                        out.write(fragment.encode('utf-8'))
+                    out.write(document_xml[body_end:].encode('utf-8'))
+        os.replace(temp_filename, output_filename)
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+def export_to_docx(passages, output_filename, debug_mode, script_start_time, stats, processes=1, source=None):
     """Esporta i passaggi elaborati in un file .docx e stampa le statistiche finali."""
     print(f"Inizio esportazione nel file DOCX: {output_filename}")
-    doc = docx.Document()
-    sorted_passages = sorted(passages, key=lambda p: p['new_id'])
-    
-    for passage in sorted_passages:
-        heading = doc.add_heading(f"Capitolo {passage['new_id']}", level=1)
-        heading.paragraph_format.keep_with_next = True
-        heading.paragraph_format.keep_together = True
-        
-        p = doc.add_paragraph()
-        p.paragraph_format.keep_together = True
-        content_parts = re.split(r'(\[\[.*?\]\])', passage['content'])
-        
-        for part in content_parts:
-            if part.startswith('[['):
-                link_text = part.strip('[]')
-                number_match = re.search(r'(\d+)', link_text)
-                if number_match:
-                    number = number_match.group(1)
-                    before_number, after_number = link_text.split(number, 1)
-                    p.add_run(before_number)
-                    p.add_run(number).bold = True
-                    p.add_run(after_number)
-                else: 
-                    p.add_run(link_text)
-            else: 
-                p.add_run(part)
-        
-        if debug_mode:
-            debug_p = doc.add_paragraph()
-            run = debug_p.add_run(f"(Debug: ID Originale: {passage['original_id']}, Rimandi Originali: [{passage.get('original_links_text', 'Nessuno')}])")
-            run.italic = True
-            run.font.size = Pt(8)
+    chapters = (
+        (p['new_id'], p['content'], _debug_text(p) if debug_mode else None)
+        for p in _iter_chapters(passages, source)
+    )
     
     try:
-        doc.save(output_filename)
+        _write_docx_package(_render_docx_fragments(chapters, len(passages), processes), output_filename)
         print(f"Successo! File '{output_filename}' creato correttamente.")
-        
-        before_avg, before_max, before_min = stats['before']
-        after_avg, after_max, after_min = stats['after']
-        
-        print("\n--- Report Statistiche Ottimizzazione (Finale) ---")
-        print(f"{'Statistica':<20} | {'Layout Iniziale':>15} | {'Risultato Finale':>18}")
-        print("-" * 60)
-        print(f"{'Distanza Media':<20} | {before_avg:>15.2f} | {after_avg:>18.2f}")
-        print(f"{'Distanza Massima':<20} | {before_max:>15} | {after_max:>18}")
-        print(f"{'Distanza Minima':<20} | {before_min:>15} | {after_min:>18}")
-        print("-" * 60)
-
-        script_end_time = time.time()
-        execution_time = script_end_time - script_start_time
-        print(f"\nTempo di esecuzione totale: {execution_time:.2f} secondi.")
-        sys.stdout.flush()
+        _print_final_report(stats, script_start_time)
     except Exception as e:
         print(f"Errore durante il salvataggio del file DOCX: {e}")
 
+# --- Esportatori leggeri (senza python-docx) ---
+
+def _escape_markdown(text):
+    """
+    Esegue l'escape del testo per il Markdown, così che caratteri come * _ ` o un
+    # a inizio riga non cambino la struttura del documento.
+    """
+    text = text.replace('&', '&amp;').replace('<', '&lt;')
+    text = re.sub(r'([\\`*_\[\]|~])', r'\\\1', text)
+    # Titoli, citazioni ed elenchi sono riconosciuti solo a inizio riga
+    text = re.sub(r'(?m)^([ \t]*)([#>+=-])', r'\1\\\2', text)
+    return re.sub(r'(?m)^([ \t]*\d+)([.)])', r'\1\\\2', text)
+
+def _odt_text(text):
+    """
+    Prepara il testo per l'ODT: come in HTML gli spazi consecutivi e i tab verrebbero
+    ridotti a un solo spazio, quindi diventano <text:s/> e <text:tab/> come nel DOCX.
+    """
+    lines = []
+    for line in _xml_text(text).split('\n'):
+        parts = re.split(r'(\t| +)', line)
+        for i in range(1, len(parts), 2):
+            if parts[i] == '\t':
+                parts[i] = '<text:tab/>'
+            elif len(parts[i]) > 1 or not parts[i - 1] or not parts[i + 1]:
+                # Anche uno spazio singolo a inizio o fine riga verrebbe rimosso
+                parts[i] = f'<text:s text:c="{len(parts[i])}"/>'
+        lines.append(''.join(parts))
+    return '<text:line-break/>'.join(lines)
+
+class StreamingExporter(ABC):
+    """
+    Interfaccia base per gli esportatori in streaming.
+    Ogni capitolo viene scritto sul file appena elaborato, senza costruire
+    il documento in memoria. Le sottoclassi definiscono estensione e markup.
+    """
+    extension = None
+    label = None
+
+    def __init__(self, out, title, debug_mode):
+        self.out = out
+        self.title = title
+        self.debug_mode = debug_mode
+
+    def begin(self):
+        """Scrive l'intestazione del documento."""
+        pass
+
+    @abstractmethod
+    def write_chapter(self, passage):
+        """Scrive un singolo capitolo."""
+
+    def end(self):
+        """Scrive la chiusura del documento."""
+        pass
+
+class MarkdownExporter(StreamingExporter):
+    """Esporta in Markdown: titolo di livello 1 per capitolo, numeri dei rimandi in grassetto."""
+    extension = '.md'
+    label = 'Markdown'
+
+    def write_chapter(self, passage):
+        self.out.write(f"# Capitolo {passage['new_id']}\n\n")
+        for text, bold in _split_link_runs(passage['content']):
+            if bold:
+                self.out.write(f"**{text}**")
+            else:
+                self.out.write(_escape_markdown(text).replace('\n', '  \n'))
+        self.out.write("\n\n")
+        if self.debug_mode:
+            self.out.write(f"*{_escape_markdown(_debug_text(passage))}*\n\n")
+
+class HtmlExporter(StreamingExporter):
+    """Esporta in un file HTML autonomo."""
+    extension = '.html'
+    label = 'HTML'
+
+    def begin(self):
+        self.out.write('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n')
+        # Tab e spazi consecutivi restano visibili come nel DOCX
+        self.out.write('<style>p { white-space: pre-wrap; }</style>\n')
+        self.out.write(f"<title>{escape(self.title)}</title>\n</head>\n<body>\n")
+
+    def write_chapter(self, passage):
+        self.out.write(f"<h1>Capitolo {passage['new_id']}</h1>\n<p>")
+        for text, bold in _split_link_runs(passage['content']):
+            text = _xml_text(text).replace('\n', '<br>')
+            self.out.write(f"<strong>{text}</strong>" if bold else text)
+        self.out.write("</p>\n")
+        if self.debug_mode:
+            self.out.write(f"<p><small><em>{_xml_text(_debug_text(passage))}</em></small></p>\n")
+
+    def end(self):
+        self.out.write("</body>\n</html>\n")
+
+class FlatOdtExporter(StreamingExporter):
+    """Esporta in formato OpenDocument piatto (.fodt), apribile con LibreOffice."""
+    extension = '.fodt'
+    label = 'ODT piatto'
+
+    def begin(self):
+        self.out.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<office:document xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0"'
+            ' xmlns:style="urn:oasis:names:tc:opendocument:xmlns:style:1.0"'
+            ' xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0"'
+            ' xmlns:fo="urn:oasis:names:tc:opendocument:xmlns:xsl-fo-compatible:1.0"'
+            ' office:version="1.2" office:mimetype="application/vnd.oasis.opendocument.text">\n'
+            '<office:styles>\n'
+            '<style:style style:name="Heading_20_1" style:display-name="Heading 1" style:family="paragraph" style:default-outline-level="1">\n'
+            '<style:paragraph-properties fo:keep-with-next="always" fo:keep-together="always"/>\n'
+            '<style:text-properties fo:font-size="16pt" fo:font-weight="bold"/>\n'
+            '</style:style>\n'
+            '</office:styles>\n'
+            '<office:automatic-styles>\n'
+            '<style:style style:name="P1" style:family="paragraph">\n'
+            '<style:paragraph-properties fo:keep-together="always"/>\n'
+            '</style:style>\n'
+            '<style:style style:name="T1" style:family="text">\n'
+            '<style:text-properties fo:font-weight="bold"/>\n'
+            '</style:style>\n'
+            '<style:style style:name="T2" style:family="text">\n'
+            '<style:text-properties fo:font-style="italic" fo:font-size="8pt"/>\n'
+            '</style:style>\n'
+            '</office:automatic-styles>\n'
+            '<office:body>\n<office:text>\n'
+        )
+
+    def write_chapter(self, passage):
+        self.out.write(
+            f'<text:h text:style-name="Heading_20_1" text:outline-level="1">Capitolo {passage["new_id"]}</text:h>\n'
+            '<text:p text:style-name="P1">'
+        )
+        for text, bold in _split_link_runs(passage['content']):
+            text = _odt_text(text)
+            self.out.write(f'<text:span text:style-name="T1">{text}</text:span>' if bold else text)
+        self.out.write("</text:p>\n")
+        if self.debug_mode:
+            self.out.write(f'<text:p><text:span text:style-name="T2">{_odt_text(_debug_text(passage))}</text:span></text:p>\n')
+
+    def end(self):
+        self.out.write("</office:text>\n</office:body>\n</office:document>\n")
+
+# Formati disponibili oltre al DOCX: per aggiungerne uno basta registrare qui la sua classe
+STREAMING_EXPORTERS = {
+    'md': MarkdownExporter,
+    'html': HtmlExporter,
+    'fodt': FlatOdtExporter,
+}
+
+def export_streaming(passages, output_filename, exporter_class, debug_mode, script_start_time, stats, source=None):
+    """Esporta i passaggi un capitolo alla volta con l'esportatore indicato e stampa le statistiche finali."""
+    print(f"Inizio esportazione nel file {exporter_class.label}: {output_filename}")
+    title = os.path.splitext(os.path.basename(output_filename))[0]
+
+    try:
+        with open(output_filename, 'w', encoding='utf-8', newline='\n') as f:
+            exporter = exporter_class(f, title, debug_mode)
+            exporter.begin()
+            for passage in _iter_chapters(passages, source):
+                exporter.write_chapter(passage)
+            exporter.end()
+        print(f"Successo! File '{output_filename}' creato correttamente.")
+        _print_final_report(stats, script_start_time)
+    except Exception as e:
+        print(f"Errore durante il salvataggio del file {exporter_class.label}: {e}")
+
 def get_input_file(cli_arg):
     """Determina il file di input."""
     if cli_arg:
@@ -501,15 +1114,38 @@ def main():
     parser.add_argument('--correzione', type=int, default=20, help="Numero di passate per risolvere le violazioni di distanza minima.\nDefault: 20.")
     parser.add_argument('--lock', type=str, default='', help="Lista di ID da bloccare, separati da virgola o spazio.\n(es. '1,21,5' o '1 21 5').")
     parser.add_argument('--debug', action='store_true', help="Attiva le informazioni di debug nel file DOCX.")
+    parser.add_argument('--processi', type=int, default=1, help="Numero di processi per generare i capitoli del DOCX.\nDefault: 1.")
+    parser.add_argument('--analisi', action='store_true', help="Invece di esportare, salva in JSON l'analisi della struttura:\ncapitoli non raggiungibili, vicoli ciechi, rimandi interrotti, cicli e distanze.")
+    parser.add_argument('--analisi-rinumera', action='store_true', help="Con --analisi, misura le distanze anche dopo la rinumerazione.\nSui libri grandi è molto più lento dell'analisi.")
+    parser.add_argument('--indice', action='store_true', help="Modalità a memoria ridotta per libri molto grandi: il testo dei capitoli\nresta nel file .twee e viene riletto solo in esportazione.")
+    parser.add_argument('--formato', choices=['docx'] + list(STREAMING_EXPORTERS), default='docx', help="Formato del file di output: docx, md, html o fodt.\nDefault: docx.")
     
     args = parser.parse_args()
     locked_ids = [item.strip() for item in args.lock.replace(',', ' ').split() if item.strip()]
     input_file = get_input_file(args.nomefile)
     
     if input_file:
-        output_file = os.path.splitext(input_file)[0] + '.docx'
-        raw_passages = parse_twee_file(input_file)
-        if raw_passages:
+        exporter_class = STREAMING_EXPORTERS.get(args.formato)
+        extension = exporter_class.extension if exporter_class else '.docx'
+        output_file = os.path.splitext(input_file)[0] + extension
+        if args.indice:
+            raw_passages, source = index_twee_file(input_file)
+        else:
+            raw_passages, source = parse_twee_file(input_file), None
+        if raw_passages and args.analisi:
+            start_id = str(parse_story_data(input_file).get('start', raw_passages[0]['original_id']))
+            export_analysis(
+                raw_passages,
+                os.path.splitext(input_file)[0] + '.analisi.json',
+                start_id,
+                script_start_time,
+                renumber=args.analisi_rinumera,
+                min_dist=args.distanza_min,
+                locked_ids=locked_ids,
+                start_number=args.inizio,
+                correction_passes=args.correzione
+            )
+        elif raw_passages:
             final_passages, stats = renumber_passages_hybrid(
                 passages=raw_passages, 
                 min_dist=args.distanza_min,
@@ -518,7 +1154,12 @@ def main():
                 correction_passes=args.correzione
             )
             if final_passages:
-                export_to_docx(final_passages, output_file, args.debug, script_start_time, stats)
+                if exporter_class:
+                    export_streaming(final_passages, output_file, exporter_class, args.debug, script_start_time, stats, source)
+                else:
+                    export_to_docx(final_passages, output_file, args.debug, script_start_time, stats, args.processi, source)
+        if source:
+            source.close()
 
 # --- ESECUZIONE PRINCIPALE ---
 if __name__ == "__main__":
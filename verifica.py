@@ -0,0 +1,336 @@
+import argparse
+import contextlib
+import io
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import zipfile
+from xml.dom import minidom
+
+import twee2docx
+
+# --- Casi del corpus di verifica ---
+
+CARTELLA_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
+# (file, ID bloccati, numero di partenza)
+CASI = [
+    ("seme1_100.twee", ["1"], 1),
+    ("seme2_300.twee", ["1", "150"], 1),
+    ("seme2_300.twee", ["1"], 101),
+    ("seme3_600.twee", ["1"], 1),
+    ("casi_limite.twee", ["Prologo", "2", "Epilogo"], 1),
+    ("casi_limite.twee", [], 1),
+]
+
+# Risultati attesi dell'analisi strutturale (--analisi) per i file scritti a mano
+ANALISI_ATTESE = {
+    "casi_limite.twee": {
+        'start': 'Prologo',
+        'unreachable': ['4'],
+        'dead_ends': ['Epilogo'],
+        'dangling_links': [{'source': '5', 'dest': '999'}, {'source': '6', 'dest': 'Capitolo perduto'}],
+        'cycles': [['1', '2', '3', '5', '6', '7', '8', '9', '10', '11', '12'], ['4']],
+    },
+}
+
+LINK_PATTERN = r'\[\[([^\]]+)\]\]'
+STATISTICHE_VUOTE = {"before": (0, 0, 0), "after": (0, 0, 0)}
+
+# --- Controlli ---
+
+def controlla_analisi(nome_file, percorso, passaggi):
+    """Verifica l'analisi strutturale: risultati attesi e stesso esito con l'indice su disco."""
+    errori = []
+    start_id = str(twee2docx.parse_story_data(percorso).get('start', passaggi[0]['original_id']))
+    rapporto = twee2docx.analyze_structure(passaggi, *twee2docx._extract_story_links(passaggi), start_id)
+
+    for chiave, atteso in ANALISI_ATTESE.get(nome_file, {}).items():
+        if rapporto[chiave] != atteso:
+            errori.append(f"analisi: '{chiave}' vale {rapporto[chiave]}, atteso {atteso}")
+
+    indicizzati, sorgente = twee2docx.index_twee_file(percorso)
+    if sorgente is None:
+        return errori + ["indicizzazione fallita"]
+    sorgente.close()
+    if twee2docx.analyze_structure(indicizzati, *twee2docx._extract_story_links(indicizzati), start_id) != rapporto:
+        errori.append("analisi: l'indice su disco dà un risultato diverso")
+    return errori
+
+def controlla_permutazione(ordine, id_map, bloccati, inizio):
+    """Verifica che i nuovi ID siano una permutazione valida degli ID disponibili."""
+    errori = []
+    if sorted(id_map) != sorted(ordine):
+        errori.append(f"capitoli persi o duplicati: attesi {len(ordine)}, rinumerati {len(id_map)}")
+        return errori
+
+    numeri_bloccati = set(bloccati.values())
+    liberi = []
+    numero = inizio
+    while len(liberi) < len(ordine) - len(bloccati):
+        if numero not in numeri_bloccati:
+            liberi.append(numero)
+        numero += 1
+
+    if sorted(id_map.values()) != sorted(numeri_bloccati | set(liberi)):
+        errori.append("i nuovi ID non sono una permutazione degli ID disponibili")
+
+    for id_originale, numero in bloccati.items():
+        if id_map[id_originale] != numero:
+            errori.append(f"capitolo bloccato {id_originale} spostato a {id_map[id_originale]}")
+    return errori
+
+def controlla_rimandi(id_originale, contenuto_originale, contenuto_nuovo, id_map):
+    """Verifica che ogni rimando riscritto punti al nuovo ID corretto e che il resto del testo sia intatto."""
+    errori = []
+    if re.split(LINK_PATTERN, contenuto_originale)[::2] != re.split(LINK_PATTERN, contenuto_nuovo)[::2]:
+        errori.append(f"capitolo {id_originale}: testo fuori dai rimandi modificato")
+
+    vecchi = re.findall(LINK_PATTERN, contenuto_originale)
+    nuovi = re.findall(LINK_PATTERN, contenuto_nuovo)
+    if len(vecchi) != len(nuovi):
+        return errori + [f"capitolo {id_originale}: {len(vecchi)} rimandi diventati {len(nuovi)}"]
+
+    for vecchio, nuovo in zip(vecchi, nuovi):
+        destinazione = re.search(r'\d+', vecchio)
+        if destinazione and destinazione.group() in id_map:
+            atteso = str(id_map[destinazione.group()])
+            trovato = re.search(r'\d+', nuovo)
+            if not trovato or trovato.group() != atteso:
+                errori.append(f"capitolo {id_originale}: [[{vecchio}]] è diventato [[{nuovo}]], atteso il numero {atteso}")
+            elif re.sub(r'\d+', '#', vecchio) != re.sub(r'\d+', '#', nuovo):
+                errori.append(f"capitolo {id_originale}: testo del rimando [[{vecchio}]] modificato in [[{nuovo}]]")
+        elif vecchio != nuovo:
+            errori.append(f"capitolo {id_originale}: [[{vecchio}]] non doveva cambiare ma è diventato [[{nuovo}]]")
+    return errori
+
+def controlla_docx(passaggi, cartella):
+    """Esporta in DOCX (sequenziale e parallelo) e verifica che il documento contenga tutti i capitoli in ordine."""
+    import docx
+
+    errori = []
+    file_docx = {}
+    for processi in (1, 2):
+        file_docx[processi] = os.path.join(cartella, f"verifica_{processi}.docx")
+        twee2docx.export_to_docx(passaggi, file_docx[processi], True, time.time(), STATISTICHE_VUOTE, processi)
+        if not os.path.exists(file_docx[processi]):
+            return [f"DOCX non creato con {processi} processi"]
+
+    documenti_xml = [zipfile.ZipFile(file_docx[processi]).read('word/document.xml') for processi in (1, 2)]
+    if documenti_xml[0] != documenti_xml[1]:
+        errori.append("il DOCX parallelo è diverso da quello sequenziale")
+
+    # document.xml oltre il limite zip64 (abbassato per non scrivere 2 GiB) e scrittura interrotta a metà
+    file_zip64 = os.path.join(cartella, "verifica_zip64.docx")
+    limite = zipfile.ZIP64_LIMIT
+    zipfile.ZIP64_LIMIT = len(documenti_xml[0]) // 2
+    try:
+        twee2docx.export_to_docx(passaggi, file_zip64, True, time.time(), STATISTICHE_VUOTE)
+    finally:
+        zipfile.ZIP64_LIMIT = limite
+    try:
+        if zipfile.ZipFile(file_zip64).read('word/document.xml') != documenti_xml[0]:
+            errori.append("il DOCX oltre il limite zip64 ha un document.xml diverso")
+    except Exception as e:
+        errori.append(f"il DOCX oltre il limite zip64 non è stato scritto correttamente: {e}")
+
+    def frammenti_interrotti():
+        yield '<w:p/>'
+        raise RuntimeError("scrittura interrotta")
+
+    file_interrotto = os.path.join(cartella, "verifica_interrotto.docx")
+    try:
+        twee2docx._write_docx_package(frammenti_interrotti(), file_interrotto)
+    except RuntimeError:
+        pass
+    if os.path.exists(file_interrotto) or os.path.exists(file_interrotto + '.tmp'):
+        errori.append("una scrittura DOCX interrotta ha lasciato un file incompleto")
+
+    try:
+        paragrafi = docx.Document(file_docx[1]).paragraphs
+    except Exception as e:
+        return errori + [f"il DOCX non si apre: {e}"]
+    titoli = [i for i, p in enumerate(paragrafi) if p.style.name == 'Heading 1']
+    ordinati = sorted(passaggi, key=lambda p: p['new_id'])
+    if [paragrafi[i].text for i in titoli] != [f"Capitolo {p['new_id']}" for p in ordinati]:
+        errori.append(f"il DOCX contiene {len(titoli)} capitoli su {len(ordinati)} o in ordine errato")
+        return errori
+
+    for i, passaggio in zip(titoli, ordinati):
+        atteso = ''.join(testo for testo, _ in twee2docx._split_link_runs(passaggio['content']))
+        atteso = twee2docx._INVALID_XML_CHARS.sub('', atteso)
+        if paragrafi[i + 1].text != atteso:
+            errori.append(f"testo del capitolo {passaggio['new_id']} diverso nel DOCX")
+    return errori
+
+def testo_odt(paragrafo):
+    """
+    Ricostruisce il testo visibile di un paragrafo ODT applicando le regole ODF sugli spazi:
+    gli spazi letterali consecutivi valgono uno e spariscono a inizio e fine riga.
+    """
+    caratteri = []  # (carattere, protetto)
+
+    def visita(nodo):
+        for figlio in nodo.childNodes:
+            if figlio.nodeType == figlio.TEXT_NODE:
+                caratteri.extend((' ' if c in ' \t\r\n' else c, False) for c in figlio.data)
+            elif figlio.tagName == 'text:s':
+                caratteri.extend([(' ', True)] * int(figlio.getAttribute('text:c') or 1))
+            elif figlio.tagName == 'text:tab':
+                caratteri.append(('\t', True))
+            elif figlio.tagName == 'text:line-break':
+                caratteri.append(('\n', True))
+            else:
+                visita(figlio)
+
+    visita(paragrafo)
+    testo = []
+    for i, (c, protetto) in enumerate(caratteri):
+        if c == ' ' and not protetto:
+            precedente = testo[-1] if testo else '\n'
+            successivo = caratteri[i + 1][0] if i + 1 < len(caratteri) else '\n'
+            if precedente in ' \n' or successivo in ' \n':
+                continue
+        testo.append(c)
+    return ''.join(testo)
+
+def controlla_formati_leggeri(passaggi, cartella):
+    """Verifica che Markdown, HTML e ODT piatto contengano tutti i capitoli e che il testo non ne alteri la struttura."""
+    errori = []
+    file_esportati = {}
+    for formato, esportatore in twee2docx.STREAMING_EXPORTERS.items():
+        file_esportati[formato] = os.path.join(cartella, f"verifica{esportatore.extension}")
+        twee2docx.export_streaming(passaggi, file_esportati[formato], esportatore, True, time.time(), STATISTICHE_VUOTE)
+        if not os.path.exists(file_esportati[formato]):
+            return [f"file {formato} non creato"]
+
+    ordinati = sorted(passaggi, key=lambda p: p['new_id'])
+    titoli_attesi = [f"Capitolo {p['new_id']}" for p in ordinati]
+    testi_attesi = [
+        twee2docx._INVALID_XML_CHARS.sub('', ''.join(testo for testo, _ in twee2docx._split_link_runs(p['content'])))
+        for p in ordinati
+    ]
+
+    with open(file_esportati['md'], encoding='utf-8') as f:
+        righe = f.read().split('\n')
+    # Ogni riga che il Markdown interpreterebbe come titolo, elenco o citazione deve essere un titolo di capitolo
+    strutturali = [r for r in righe if re.match(r'[ \t]*([#>+=-]|\d+[.)])', r)]
+    if strutturali != [f"# {titolo}" for titolo in titoli_attesi]:
+        errori.append("il Markdown contiene titoli, elenchi o citazioni non previsti")
+    if '<' in ''.join(righe):
+        errori.append("il Markdown contiene HTML non protetto")
+
+    try:
+        documento = minidom.parse(file_esportati['fodt'])
+        titoli = [h.firstChild.data for h in documento.getElementsByTagName('text:h')]
+        if titoli != titoli_attesi:
+            errori.append(f"l'ODT piatto contiene {len(titoli)} capitoli su {len(titoli_attesi)} o in ordine errato")
+        paragrafi = [p for p in documento.getElementsByTagName('text:p') if p.getAttribute('text:style-name') == 'P1']
+        for paragrafo, atteso, titolo in zip(paragrafi, testi_attesi, titoli_attesi):
+            if testo_odt(paragrafo) != atteso:
+                errori.append(f"l'ODT piatto perde tab o spazi nel {titolo.lower()}")
+    except Exception as e:
+        errori.append(f"l'ODT piatto non è XML valido: {e}")
+
+    with open(file_esportati['html'], encoding='utf-8') as f:
+        html = f.read()
+    titoli = re.findall(r'<h1>(.*?)</h1>', html)
+    if titoli != titoli_attesi:
+        errori.append(f"l'HTML contiene {len(titoli)} capitoli su {len(titoli_attesi)} o in ordine errato")
+    if 'white-space: pre-wrap' not in html or html.count('\t') != ''.join(testi_attesi).count('\t'):
+        errori.append("l'HTML non conserva tab e spazi consecutivi")
+    return errori
+
+def controlla_indice(percorso, passaggi, cartella):
+    """Verifica che la modalità a memoria ridotta (--indice) produca lo stesso DOCX della modalità normale."""
+    indicizzati, sorgente = twee2docx.index_twee_file(percorso)
+    if sorgente is None:
+        return ["indicizzazione fallita"]
+    try:
+        if [p['original_id'] for p in indicizzati] != [p['original_id'] for p in passaggi]:
+            return ["l'indice non contiene gli stessi capitoli, nello stesso ordine"]
+        id_map = {p['original_id']: p['new_id'] for p in passaggi}
+        for p in indicizzati:
+            p['new_id'] = id_map[p['original_id']]
+        file_indice = os.path.join(cartella, "verifica_indice.docx")
+        twee2docx.export_to_docx(indicizzati, file_indice, True, time.time(), STATISTICHE_VUOTE, 1, sorgente)
+    finally:
+        sorgente.close()
+
+    documenti_xml = [zipfile.ZipFile(f).read('word/document.xml') for f in (os.path.join(cartella, "verifica_1.docx"), file_indice)]
+    if documenti_xml[0] != documenti_xml[1]:
+        return ["il DOCX generato dall'indice su disco è diverso da quello normale"]
+    return []
+
+def verifica_caso(nome_file, bloccati, inizio, args):
+    """Esegue l'intera procedura su un file del corpus e restituisce la lista degli errori trovati."""
+    uscita = sys.stdout if args.verbose else io.StringIO()
+    with contextlib.redirect_stdout(uscita):
+        percorso = os.path.join(CARTELLA_CORPUS, nome_file)
+        passaggi = twee2docx.parse_twee_file(percorso)
+        originali = {p['original_id']: p['content'] for p in passaggi}
+        ordine = [p['original_id'] for p in passaggi]
+        errori_analisi = controlla_analisi(nome_file, percorso, passaggi)
+
+        random.seed(args.seme)
+        finali, _ = twee2docx.renumber_passages_hybrid(
+            passages=passaggi,
+            min_dist=args.distanza_min,
+            locked_ids=bloccati,
+            start_number=inizio,
+            correction_passes=args.correzione
+        )
+        id_map = {p['original_id']: p['new_id'] for p in finali}
+        id_bloccati = {id_originale: int(id_originale) for id_originale in ordine if id_originale in bloccati and id_originale.isdigit()}
+
+        errori = errori_analisi + controlla_permutazione(ordine, id_map, id_bloccati, inizio)
+        for p in finali:
+            errori += controlla_rimandi(p['original_id'], originali[p['original_id']], p['content'], id_map)
+        with tempfile.TemporaryDirectory() as cartella:
+            errori += controlla_docx(finali, cartella)
+            errori += controlla_formati_leggeri(finali, cartella)
+            errori += controlla_indice(percorso, finali, cartella)
+    return errori
+
+def main():
+    """Funzione principale che gestisce i parametri da riga di comando."""
+    parser = argparse.ArgumentParser(
+        description="Verifica twee2docx sul corpus di file .twee della cartella 'corpus'.",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        '--seme', type=int, default=0,
+        help='Seme del generatore casuale usato durante la rinumerazione.\nDefault: 0'
+    )
+    parser.add_argument(
+        '--distanza-min', type=int, default=10,
+        help='Distanza MINIMA tra capitoli collegati.\nDefault: 10'
+    )
+    parser.add_argument(
+        '--correzione', type=int, default=20,
+        help='Numero di passate per risolvere le violazioni di distanza minima.\nDefault: 20'
+    )
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='Mostra anche i messaggi di twee2docx.'
+    )
+    args = parser.parse_args()
+
+    falliti = 0
+    for nome_file, bloccati, inizio in CASI:
+        errori = verifica_caso(nome_file, bloccati, inizio, args)
+        esito = "OK" if not errori else "ERRORE"
+        print(f"[{esito}] {nome_file} (lock: {', '.join(bloccati) or 'nessuno'}, inizio: {inizio})")
+        for errore in errori:
+            print(f"    - {errore}")
+        falliti += bool(errori)
+
+    print("-" * 50)
+    print(f"Casi verificati: {len(CASI)}, falliti: {falliti}")
+    sys.exit(1 if falliti else 0)
+
+if __name__ == '__main__':
+    main()